@@ -26,7 +26,7 @@ def handle_screen_share_offer(data):
         return
 
     # Identify the teacher's socket
-    teacher_sid = rooms_data[room_code].get("teacherSocketId")
+    teacher_sid = rooms_data[room_code].teacher_sid
     if not teacher_sid:
         emit("session_error", {"error": f"No teacher socket found for room {room_code}."}, broadcast=False)
         return
@@ -58,10 +58,9 @@ def handle_screen_share_answer(data):
         return
 
     # We need a way to map this studentId to their socket
-    # If you store a mapping in rooms_data, e.g.:
-    # rooms_data[roomCode]["studentSockets"] = { studentId -> sid }
-    # Then we can look it up:
-    student_sockets = rooms_data[room_code].get("studentSockets", {})
+    # TSserver keeps that mapping on the Room:
+    # rooms_data[roomCode].student_sockets = { studentId -> sid }
+    student_sockets = rooms_data[room_code].student_sockets
     student_sid = student_sockets.get(student_id)
     if not student_sid:
         emit("session_error", {"error": f"Student {student_id} socket not found."}, broadcast=False)
@@ -95,7 +94,7 @@ def handle_ice_candidate(data):
         return
 
     if to_whom == 'teacher':
-        teacher_sid = rooms_data[room_code].get("teacherSocketId")
+        teacher_sid = rooms_data[room_code].teacher_sid
         if teacher_sid:
             socketio.emit("ice_candidate", {
                 "candidate": candidate,
@@ -104,7 +103,7 @@ def handle_ice_candidate(data):
             }, room=teacher_sid)
     else:
         # to_whom == 'student'
-        student_sockets = rooms_data[room_code].get("studentSockets", {})
+        student_sockets = rooms_data[room_code].student_sockets
         student_sid = student_sockets.get(student_id)
         if student_sid:
             socketio.emit("ice_candidate", {
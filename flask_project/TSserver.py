@@ -3,32 +3,77 @@ TSserver.py – Now integrates with ScreenShare + studentId mapping
 """
 
 import os
-import base64
+import atexit
+import codecs
+import collections
+import ctypes
 import glob
-import pexpect
+import hashlib
+import logging
+import queue
 import tempfile
 import threading
+import time
+import selectors
 import shlex
 import shutil
+import signal
+import sqlite3
+import subprocess
 import re
 import random
 import string
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 from flask import Flask, request
 from flask_cors import CORS
 from flask_socketio import SocketIO, join_room, leave_room
 
+# libvips resizes with a streaming decode and SIMD kernels; Pillow is the
+# fallback, and without either plots are sent as-is.
+try:
+    import pyvips
+    VIPS_ENABLED = True
+except (ImportError, OSError):
+    VIPS_ENABLED = False
+
 try:
     from PIL import Image
     PIL_ENABLED = True
 except ImportError:
     PIL_ENABLED = False
 
+# Linux inotify (through libc) lets us pick up plot files as soon as the
+# user's program closes them; elsewhere we fall back to a glob scan when the
+# process ends. The inotify fd itself is only created by
+# ensure_session_runtime.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct("iIII")
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+plot_watch_fd = -1
+INOTIFY_ENABLED = False
+
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app)
 app.config['SECRET_KEY'] = 'some_secret_key'
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Session output is read with blocking select()/os.read() calls, so pin the
+# threading driver: Flask-SocketIO would otherwise pick eventlet/gevent when
+# one is installed, and an un-patched select() would stall its whole hub.
+# Set SOCKETIO_MESSAGE_QUEUE (e.g. redis://localhost:6379/0) to route emits
+# through a shared queue, so that other server processes can broadcast to
+# these rooms. rooms_data itself is still per process.
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading",
+                    message_queue=os.environ.get("SOCKETIO_MESSAGE_QUEUE"))
 
 # <<< ADDED: Import the screen share events >>>
 import ScreenShare  # This file contains @socketio.on("screen_share_offer"), etc.
@@ -36,24 +81,69 @@ import ScreenShare  # This file contains @socketio.on("screen_share_offer"), etc
 # ------------------
 # 1) Data Structures
 # ------------------
+@dataclass(slots=True)
+class Room:
+    teacher_sid: str
+    participants: set = field(default_factory=set)
+    task_text: str = ""
+    time_limit: int = 0
+    exam_ended: bool = False
+    submitted_users: set = field(default_factory=set)
+    # <<< ADDED: map studentId -> sid
+    student_sockets: dict = field(default_factory=dict)
+
 rooms_data = {}
-# example:
-# rooms_data = {
-#   "ABC123": {
-#       "teacherSocketId": "...",
-#       "participants": set([...]),
-#       "taskText": "",
-#       "timeLimit": 0,
-#       "examEnded": False,
-#       "submittedUsers": set(),
-#       # <<< ADDED: store a dict for student IDs
-#       "studentSockets": { "someStudentId": "theStudentSocketId" }
-#   }
-# }
+# rooms_data = { "ABC123": Room(teacher_sid="...", ...) }
+
+# Flat reverse indexes so a disconnect can be cleaned up without scanning
+# every room: sid -> roomCode it joined, sid -> studentId it registered.
+SID_TO_ROOM = {}
+SID_TO_STUDENT = {}
 
 ephemeral_sessions = {}
 # ephemeral_sessions[sid] = { ... }  # unchanged
 
+# Every running session's PTY is registered here and served by a single
+# reader thread (see run_output_selector).
+output_selector = selectors.DefaultSelector()
+output_selector_lock = threading.Lock()
+# Streams of sessions that were cleaned up, waiting for the selector thread
+# to unregister and close their PTY.
+closed_streams = collections.deque()
+
+# inotify watch descriptor -> (sid, session_obj, temp_dir) of the session
+# whose temp dir is being watched for plot files.
+plot_watches = {}
+
+# Set once the inotify fd and the selector thread exist (see
+# ensure_session_runtime).
+session_runtime_lock = threading.Lock()
+session_runtime_started = False
+
+# Plot handling and end-of-session cleanup run on this pool. Each session's
+# tasks are queued on the session itself and run one at a time, so its plots
+# are always sent before its temp dir is released, while different sessions
+# proceed in parallel (see submit_session_task).
+SESSION_WORKERS = ThreadPoolExecutor(max_workers=4)
+session_tasks_lock = threading.Lock()
+
+# Emptying a temp dir is blocking file I/O that can take a while (compiled
+# binaries, matplotlib caches), so it never runs on the thread that ends the
+# session.
+CLEANUP_POOL = ThreadPoolExecutor(max_workers=2)
+
+# Compiled artifacts of recent C/C++/Java submissions, keyed by a hash of the
+# language, build/run commands and source; least recently used entries are
+# evicted beyond COMPILE_CACHE_SIZE.
+COMPILE_CACHE_SIZE = 32
+COMPILE_CACHE = collections.OrderedDict()  # key -> (cache_dir, compiler output)
+compile_cache_lock = threading.Lock()
+
+# Emptied session temp dirs, ready for reuse (see acquire_session_dir and
+# release_session_dir). It starts empty and fills as sessions end.
+DIR_POOL_SIZE = 64
+DIR_POOL = queue.Queue(maxsize=DIR_POOL_SIZE)
+
 LANG_EXTENSIONS = {
     "python": "py",
     "c": "c",
@@ -74,11 +164,44 @@ LANG_COMMANDS = {
     "sql": ""
 }
 
+SESSION_ENV = dict(os.environ, TERM="dumb")
+
+# prepopulate.sql seeds every SQL session's database; read it once at import.
+PREPOP_PATH = os.path.join(os.path.dirname(__file__), "prepopulate.sql")
+PREPOP_SQL = None
+if os.path.exists(PREPOP_PATH):
+    with open(PREPOP_PATH, "r", encoding="utf-8") as f:
+        PREPOP_SQL = f.read()
+
+PLOT_PATTERNS = ["*.png", "*.jpg", "*.jpeg"]
+PLOT_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# PTY reads pull up to this many bytes at once; the poll interval bounds how
+# long the output selector sleeps when no session has output pending.
+READ_CHUNK_SIZE = 4096
+READ_POLL_INTERVAL = 0.5
+
+# Output is buffered and sent as one python_output event once it reaches
+# OUTPUT_FLUSH_BYTES or has been waiting for OUTPUT_FLUSH_INTERVAL seconds.
+OUTPUT_FLUSH_BYTES = 2048
+OUTPUT_FLUSH_INTERVAL = 0.03
+
+# After a session's program exits, wait at most this long for the PTY to
+# report EOF before ending the session anyway.
+DRAIN_TIMEOUT = 0.5
+
+# gcc/g++/javac get this many seconds per step before they are killed.
+COMPILE_TIMEOUT = 30
+
+ROOM_CODE_ALPHABET = string.ascii_uppercase + string.digits
+
 def generate_room_code():
-    return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6))
+    return ''.join(random.choices(ROOM_CODE_ALPHABET, k=6))
+
+JAVA_CLASS_RE = re.compile(r"public\s+class\s+([A-Za-z_]\w*)")
 
 def find_public_class_name(java_code):
-    match = re.search(r"public\s+class\s+([A-Za-z_]\w*)", java_code)
+    match = JAVA_CLASS_RE.search(java_code)
     return match.group(1) if match else None
 
 @app.route("/")
@@ -91,35 +214,30 @@ def index():
 @socketio.on("create_room")
 def handle_create_room():
     code = generate_room_code()
-    rooms_data[code] = {
-        "teacherSocketId": request.sid,
-        "participants": set(),
-        "taskText": "",
-        "timeLimit": 0,
-        "examEnded": False,
-        "submittedUsers": set(),
-        # <<< ADDED >>>
-        "studentSockets": {}  # map studentId -> sid
-    }
+    # never hand out a code that is still in use; that would overwrite the room
+    while code in rooms_data:
+        code = generate_room_code()
+    rooms_data[code] = Room(teacher_sid=request.sid)
     join_room(code)
     socketio.emit("room_created", {"roomCode": code}, room=request.sid)
 
 @socketio.on("send_task")
 def handle_send_task(data):
     roomCode = data.get("roomCode")
-    taskText = data.get("taskText", "")
-    timeLimit = data.get("timeLimit", 0)
-
-    if roomCode not in rooms_data:
+    room = rooms_data.get(roomCode)
+    if room is None:
         socketio.emit("session_error",
                       {"error": f"Room {roomCode} not found"},
                       room=request.sid)
         return
 
-    rooms_data[roomCode]["taskText"] = taskText
-    rooms_data[roomCode]["timeLimit"] = timeLimit
-    rooms_data[roomCode]["examEnded"] = False
-    rooms_data[roomCode]["submittedUsers"].clear()
+    taskText = data.get("taskText", "")
+    timeLimit = data.get("timeLimit", 0)
+
+    room.task_text = taskText
+    room.time_limit = timeLimit
+    room.exam_ended = False
+    room.submitted_users.clear()
 
     socketio.emit("new_task", {
         "taskText": taskText,
@@ -129,80 +247,98 @@ def handle_send_task(data):
 @socketio.on("end_exam")
 def handle_end_exam(data):
     roomCode = data.get("roomCode")
-    if not roomCode or (roomCode not in rooms_data):
+    room = rooms_data.get(roomCode)
+    if room is None:
         return
 
-    rooms_data[roomCode]["examEnded"] = True
+    room.exam_ended = True
     socketio.emit("exam_ended", {}, room=roomCode)
 
 @socketio.on("close_room")
 def handle_close_room(data):
     roomCode = data.get("roomCode")
-    if not roomCode or (roomCode not in rooms_data):
+    room = rooms_data.pop(roomCode, None)
+    if room is None:
         return
 
     socketio.emit("room_closed", {}, room=roomCode)
-    del rooms_data[roomCode]
+    for sid in room.participants:
+        if SID_TO_ROOM.get(sid) == roomCode:
+            SID_TO_ROOM.pop(sid, None)
+            SID_TO_STUDENT.pop(sid, None)
 
 @socketio.on("join_room")
 def handle_join_room(data):
+    sid = request.sid
     roomCode = data.get("roomCode")
-    studentName = data.get("name", "Unknown")
-    # <<< ADDED: check if there's a studentId
-    studentId = data.get("studentId")
-
-    if roomCode not in rooms_data:
+    room = rooms_data.get(roomCode)
+    if room is None:
         socketio.emit("session_error",
                       {"error": f"Room {roomCode} not found"},
-                      room=request.sid)
+                      room=sid)
         return
 
+    studentName = data.get("name", "Unknown")
+    # <<< ADDED: check if there's a studentId
+    studentId = data.get("studentId")
+
     join_room(roomCode)
-    rooms_data[roomCode]["participants"].add(request.sid)
+    room.participants.add(sid)
+    SID_TO_ROOM[sid] = roomCode
 
     # <<< ADDED: If this user has a studentId, store it
     if studentId:
-        if "studentSockets" not in rooms_data[roomCode]:
-            rooms_data[roomCode]["studentSockets"] = {}
-        rooms_data[roomCode]["studentSockets"][studentId] = request.sid
+        room.student_sockets[studentId] = sid
+        SID_TO_STUDENT[sid] = studentId
 
     socketio.emit("student_joined", {
         "studentName": studentName
     }, room=roomCode)
 
+@socketio.on("disconnect")
+def handle_disconnect(reason=None):
+    sid = request.sid
+    cleanup_ephemeral_session(sid)
+
+    roomCode = SID_TO_ROOM.pop(sid, None)
+    studentId = SID_TO_STUDENT.pop(sid, None)
+    room = rooms_data.get(roomCode)
+    if room is None:
+        return
+
+    leave_room(roomCode)
+    room.participants.discard(sid)
+    if studentId and room.student_sockets.get(studentId) == sid:
+        del room.student_sockets[studentId]
+
 @socketio.on("submit_solution")
 def handle_submit_solution(data):
-    roomCode    = data.get("roomCode")
-    studentName = data.get("name", "Unknown")
-    code        = data.get("code", "")
-    language    = data.get("language", "")
-    taskId      = data.get("taskId", None)
-
-    if roomCode not in rooms_data:
+    sid = request.sid
+    roomCode = data.get("roomCode")
+    room = rooms_data.get(roomCode)
+    if room is None:
         socketio.emit("session_error",
                       {"error": f"Room {roomCode} not found"},
-                      room=request.sid)
+                      room=sid)
         return
 
-    if rooms_data[roomCode]["examEnded"]:
+    if room.exam_ended:
         socketio.emit("session_error",
                       {"error": "Exam ended. No more submissions."},
-                      room=request.sid)
+                      room=sid)
         return
 
-    if request.sid in rooms_data[roomCode]["submittedUsers"]:
+    submitted = room.submitted_users
+    if sid in submitted:
         # quietly ignore second submission
         return
-
-    rooms_data[roomCode]["submittedUsers"].add(request.sid)
-
-    code = code.rstrip()
+    submitted.add(sid)
 
     socketio.emit("solution_submitted", {
-        "studentName": studentName,
-        "code": code,
-        "language": language,
-        "taskId": taskId
+        "studentName": data.get("name", "Unknown"),
+        "code": data.get("code", "").rstrip(),
+        "language": data.get("language", ""),
+        "taskId": data.get("taskId")
     }, room=roomCode)
 
 # ------------------------------------------------
@@ -216,28 +352,45 @@ def start_session(data):
     language = data.get("language", "python").strip().lower()
 
     if not code:
-        socketio.emit("session_error", {"error": "No code provided"}, room=sid)
+        socketio.emit("session_error", {"error": "No code provided"}, to=sid)
         return
     if language not in LANG_EXTENSIONS:
-        socketio.emit("session_error", {"error": f"Unsupported language '{language}'"}, room=sid)
+        socketio.emit("session_error", {"error": f"Unsupported language '{language}'"}, to=sid)
         return
 
+    ensure_session_runtime()
     cleanup_ephemeral_session(sid)
 
-    ephemeral_sessions[sid] = {
+    session_obj = {
         "child": None,
+        "compile_child": None,
         "temp_dir": None,
         "sql_temp_dir": None,
         "temp_file": None,
-        "thread": None,
+        "stream": None,
+        "plot_watch": None,
         "closing": False,
-        "sent_images": set()
+        "starting": True,
+        "deferred_dirs": [],
+        "lock": threading.Lock(),
+        "sent_images": set(),
+        "tasks": collections.deque(),
+        "tasks_running": False
     }
-    session_obj = ephemeral_sessions[sid]
+    ephemeral_sessions[sid] = session_obj
+    try:
+        setup_session(sid, session_obj, code, language)
+    finally:
+        finish_session_start(sid, session_obj)
 
+def setup_session(sid, session_obj, code, language):
+    # A Stop, disconnect or second start_session can close the session at any
+    # point while this runs; its dirs stay ours until finish_session_start.
     if language != "sql":
-        tmp_dir = tempfile.mkdtemp(prefix="user_session_")
-        session_obj["temp_dir"] = tmp_dir
+        tmp_dir = assign_session_dir(session_obj, "temp_dir")
+        if not session_is_live(sid, session_obj):
+            return
+        watch_plot_dir(sid, session_obj, tmp_dir)
 
         extension = LANG_EXTENSIONS[language]
         code_file_name = f"user_code.{extension}"
@@ -253,185 +406,583 @@ def start_session(data):
             else:
                 run_cmd = "javac user_code.java && java user_code"
 
+        if not session_is_live(sid, session_obj):
+            return
         with open(code_path, "w", encoding="utf-8") as f:
             f.write(code)
 
-        shell_cmd = f"cd {shlex.quote(tmp_dir)} && env TERM=dumb {run_cmd}"
+        # Compile steps (everything before the last "&&") run to completion
+        # here; only the final program gets a PTY, and no shell is involved.
+        *compile_steps, run_argv = [shlex.split(step) for step in run_cmd.split("&&")]
         try:
-            child = pexpect.spawn("/bin/bash", ["-c", shell_cmd], encoding="utf-8", timeout=None)
+            if compile_steps and not compile_session_code(sid, session_obj, language, run_cmd,
+                                                          code, compile_steps, tmp_dir):
+                # stopped or re-run while compiling: cleanup already happened
+                if session_is_live(sid, session_obj):
+                    socketio.emit("process_ended", {}, to=sid)
+                    cleanup_ephemeral_session(sid, session_obj)
+                return
+
+            if not session_is_live(sid, session_obj):
+                return
+            child, child_fd = spawn_session_process(run_argv, tmp_dir)
         except Exception as e:
-            socketio.emit("session_error", {"error": str(e)}, room=sid)
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            ephemeral_sessions.pop(sid, None)
+            if session_is_live(sid, session_obj):
+                socketio.emit("session_error", {"error": str(e)}, to=sid)
+            cleanup_ephemeral_session(sid, session_obj)
             return
 
-        session_obj["child"] = child
-        session_obj["temp_file"] = code_path
-
-        def read_output():
-            try:
-                while not session_obj["closing"] and child.isalive():
-                    try:
-                        chunk = child.read_nonblocking(size=1, timeout=0.1)
-                        if chunk:
-                            socketio.emit("python_output", {"data": chunk}, room=sid)
-                    except pexpect.exceptions.TIMEOUT:
-                        pass
-                    except pexpect.exceptions.EOF:
-                        break
-
-                if not session_obj["closing"]:
-                    leftover = ""
-                    try:
-                        leftover = child.read()
-                    except:
-                        pass
-                    if leftover:
-                        socketio.emit("python_output", {"data": leftover}, room=sid)
-            except Exception as e:
-                socketio.emit("session_error", {"error": str(e)}, room=sid)
-
-            if not session_obj["closing"]:
-                scan_for_new_images(sid)
-                socketio.emit("process_ended", {}, room=sid)
-
-            cleanup_ephemeral_session(sid)
-
-        t = threading.Thread(target=read_output, daemon=True)
-        session_obj["thread"] = t
-        t.start()
-
-        socketio.emit("session_started", {}, room=sid)
+        start_session_output(sid, session_obj, child, child_fd, code_path)
         return
 
     # If language == "sql"
-    tmp_dir = tempfile.mkdtemp(prefix="sql_session_")
-    session_obj["sql_temp_dir"] = tmp_dir
+    tmp_dir = assign_session_dir(session_obj, "sql_temp_dir")
 
-    prepop_path = os.path.join(os.path.dirname(__file__), "prepopulate.sql")
-    if os.path.exists(prepop_path):
-        shell_cmd = f"cd {shlex.quote(tmp_dir)} && sqlite3 ephemeral.db < {shlex.quote(prepop_path)}"
-        os.system(shell_cmd)
+    # Seed the database in-process rather than through a shell + sqlite3 CLI.
+    if PREPOP_SQL is not None:
+        if not session_is_live(sid, session_obj):
+            return
+        conn = sqlite3.connect(os.path.join(tmp_dir, "ephemeral.db"))
+        try:
+            conn.executescript(PREPOP_SQL)
+        except sqlite3.Error as e:
+            socketio.emit("python_output", {"data": f"[prepopulate.sql: {e}]\n"}, to=sid)
+        finally:
+            conn.close()
 
+    if not session_is_live(sid, session_obj):
+        return
     code_path = os.path.join(tmp_dir, "user_code.sql")
     with open(code_path, "w", encoding="utf-8") as f:
         f.write(code)
 
-    shell_cmd = f"cd {shlex.quote(tmp_dir)} && env TERM=dumb sqlite3 ephemeral.db < user_code.sql"
     try:
-        child = pexpect.spawn("/bin/bash", ["-c", shell_cmd], encoding="utf-8", timeout=None)
+        if not session_is_live(sid, session_obj):
+            return
+        with open(code_path, "rb") as script:
+            child, child_fd = spawn_session_process(["sqlite3", "ephemeral.db"], tmp_dir,
+                                                    stdin=script)
     except Exception as e:
-        socketio.emit("session_error", {"error": str(e)}, room=sid)
-        ephemeral_sessions.pop(sid, None)
+        if session_is_live(sid, session_obj):
+            socketio.emit("session_error", {"error": str(e)}, to=sid)
+        cleanup_ephemeral_session(sid, session_obj)
         return
 
+    start_session_output(sid, session_obj, child, child_fd, code_path)
+
+def start_session_output(sid, session_obj, child, child_fd, code_path):
     session_obj["child"] = child
     session_obj["temp_file"] = code_path
+    if not session_is_live(sid, session_obj):
+        # cleanup ran while we were spawning and may have missed the child
+        kill_session_process(child)
+        os.close(child_fd)
+        return
+
+    watch_session_output(sid, session_obj, child, child_fd)
+
+    socketio.emit("session_started", {}, to=sid)
+
+def assign_session_dir(session_obj, key):
+    tmp_dir = acquire_session_dir()
+    with session_obj["lock"]:
+        session_obj[key] = tmp_dir
+    return tmp_dir
+
+def finish_session_start(sid, session_obj):
+    # The starting handler is done with its dirs: if the session was closed
+    # (or replaced under the same sid) meanwhile, release them only now.
+    if not session_is_live(sid, session_obj):
+        cleanup_ephemeral_session(sid, session_obj)
+    with session_obj["lock"]:
+        session_obj["starting"] = False
+        if not session_obj["closing"]:
+            return
+        dirs = session_obj["deferred_dirs"]
+        session_obj["deferred_dirs"] = []
+    for tmp_dir in dirs:
+        CLEANUP_POOL.submit(release_session_dir, tmp_dir, session_obj)
+
+def session_is_live(sid, session_obj):
+    return not session_obj["closing"] and ephemeral_sessions.get(sid) is session_obj
+
+def compile_session_code(sid, session_obj, language, run_cmd, code, compile_steps, tmp_dir):
+    # Identical source + commands reuse the artifacts of an earlier compile
+    # instead of running gcc/g++/javac again. Each compiler runs as
+    # session_obj["compile_child"] so a Stop/disconnect can kill it; returns
+    # False if a step fails, times out, or the session is closed meanwhile.
+    key = compile_cache_key(language, run_cmd, code)
+    output = restore_compiled(key, tmp_dir)
+    if output is not None:
+        if output:
+            socketio.emit("python_output", {"data": output}, to=sid)
+        return True
+
+    before = set(os.listdir(tmp_dir))
+    output = ""
+    for argv in compile_steps:
+        proc = subprocess.Popen(argv, cwd=tmp_dir, env=SESSION_ENV,
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=True)
+        session_obj["compile_child"] = proc
+        if not session_is_live(sid, session_obj):
+            kill_session_process(proc)
+            return False
+
+        timed_out = False
+        try:
+            stdout, _ = proc.communicate(timeout=COMPILE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            kill_session_process(proc)
+            stdout, _ = proc.communicate()
+            timed_out = True
+        session_obj["compile_child"] = None
+        if not session_is_live(sid, session_obj):
+            return False
+
+        step_output = stdout.decode("utf-8", errors="replace")
+        if timed_out:
+            step_output += f"[Compilation timed out after {COMPILE_TIMEOUT}s]\n"
+        if step_output:
+            socketio.emit("python_output", {"data": step_output}, to=sid)
+        if timed_out or proc.returncode != 0:
+            return False
+        output += step_output
+
+    store_compiled(key, tmp_dir, set(os.listdir(tmp_dir)) - before, output)
+    return True
+
+def compile_cache_key(language, run_cmd, code):
+    h = hashlib.blake2b(digest_size=16)
+    for part in (language, run_cmd, code):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def copy_dir_entries(src_dir, names, dst_dir):
+    for name in names:
+        src = os.path.join(src_dir, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(dst_dir, name), dirs_exist_ok=True)
+        else:
+            shutil.copy2(src, dst_dir)
+
+def restore_compiled(key, tmp_dir):
+    # Returns the cached compiler output on a hit, None on a miss.
+    with compile_cache_lock:
+        entry = COMPILE_CACHE.get(key)
+        if entry is None:
+            return None
+        COMPILE_CACHE.move_to_end(key)
+    cache_dir, output = entry
+    try:
+        copy_dir_entries(cache_dir, os.listdir(cache_dir), tmp_dir)
+    except OSError:
+        # evicted while we were copying; just compile again
+        return None
+    return output
+
+def store_compiled(key, tmp_dir, names, output):
+    cache_dir = tempfile.mkdtemp(prefix="compile_cache_")
+    try:
+        copy_dir_entries(tmp_dir, names, cache_dir)
+    except OSError:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return
+
+    evicted = []
+    with compile_cache_lock:
+        if key in COMPILE_CACHE:
+            evicted.append(COMPILE_CACHE.pop(key)[0])
+        COMPILE_CACHE[key] = (cache_dir, output)
+        while len(COMPILE_CACHE) > COMPILE_CACHE_SIZE:
+            evicted.append(COMPILE_CACHE.popitem(last=False)[1][0])
+    for old_dir in evicted:
+        CLEANUP_POOL.submit(shutil.rmtree, old_dir, ignore_errors=True)
+
+def drain_compile_cache():
+    with compile_cache_lock:
+        for cache_dir, _output in COMPILE_CACHE.values():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        COMPILE_CACHE.clear()
+
+atexit.register(drain_compile_cache)
+
+def spawn_session_process(argv, cwd, stdin=None):
+    # Start argv on a fresh PTY in its own session/process group, so that
+    # kill_session_process can take down anything it forks as well.
+    master_fd, slave_fd = os.openpty()
+    try:
+        child = subprocess.Popen(argv, cwd=cwd, env=SESSION_ENV,
+                                 stdin=stdin if stdin is not None else slave_fd,
+                                 stdout=slave_fd, stderr=slave_fd,
+                                 start_new_session=True)
+    except Exception:
+        os.close(master_fd)
+        raise
+    finally:
+        os.close(slave_fd)
+    return child, master_fd
+
+def kill_session_process(child):
+    try:
+        os.killpg(child.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    child.wait()
+
+def watch_session_output(sid, session_obj, child, child_fd):
+    # Hand the child's PTY to the shared output selector. Only the selector
+    # thread closes the fd (see release_session_output), so the number cannot
+    # be reused by another session while a read on it may still be pending.
+    stream = {
+        "sid": sid,
+        "session": session_obj,
+        "child": child,
+        "fd": child_fd,
+        "lock": threading.Lock(),
+        "decoder": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+        "buf": bytearray(),
+        "last_flush_ts": time.monotonic(),
+        "drain_deadline": None
+    }
+    session_obj["stream"] = stream
+    with output_selector_lock:
+        output_selector.register(child_fd, selectors.EVENT_READ, data=stream)
+
+def release_session_output(stream, pending):
+    # Runs on the selector thread only.
+    fd = stream["fd"]
+    if fd is None:
+        return
+    with output_selector_lock:
+        try:
+            output_selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+    pending.pop(fd, None)
+    with stream["lock"]:
+        # forget the number first: even if close fails it must not be reused
+        stream["fd"] = None
+        os.close(fd)
+
+def flush_session_output(stream, final=False):
+    buf = stream["buf"]
+    text = stream["decoder"].decode(bytes(buf), final=final)
+    buf.clear()
+    stream["last_flush_ts"] = time.monotonic()
+    if text and not stream["session"]["closing"]:
+        socketio.emit("python_output", {"data": text}, to=stream["sid"])
+
+def submit_session_task(session_obj, fn, *args):
+    with session_tasks_lock:
+        session_obj["tasks"].append((fn, args))
+        if session_obj["tasks_running"]:
+            return
+        session_obj["tasks_running"] = True
+    SESSION_WORKERS.submit(run_session_tasks, session_obj)
+
+def run_session_tasks(session_obj):
+    while True:
+        with session_tasks_lock:
+            if not session_obj["tasks"]:
+                session_obj["tasks_running"] = False
+                return
+            fn, args = session_obj["tasks"].popleft()
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception("session task %s failed", fn.__name__)
+
+def finish_session_output(stream):
+    sid = stream["sid"]
+    session_obj = stream["session"]
+    if session_is_live(sid, session_obj):
+        if not INOTIFY_ENABLED:
+            scan_for_new_images(sid, session_obj)
+        socketio.emit("process_ended", {}, to=sid)
+    cleanup_ephemeral_session(sid, session_obj)
+
+def read_session_output(stream, pending):
+    # Pull whatever the PTY has buffered in one read; output is coalesced into
+    # one python_output event per OUTPUT_FLUSH_BYTES/OUTPUT_FLUSH_INTERVAL.
+    if stream["session"]["closing"]:
+        release_session_output(stream, pending)
+        return
+
+    try:
+        data = os.read(stream["fd"], READ_CHUNK_SIZE)
+    except OSError:
+        # EIO: the slave side is closed, i.e. the process is gone
+        data = b""
+
+    if data:
+        stream["buf"] += data
+        pending[stream["fd"]] = stream
+        if len(stream["buf"]) >= OUTPUT_FLUSH_BYTES:
+            flush_session_output(stream)
+        return
 
-    def read_sql_output():
+    end_session_output(stream, pending)
+
+def end_session_output(stream, pending):
+    flush_session_output(stream, final=True)
+    release_session_output(stream, pending)
+    # Plots the program wrote are already queued on the inotify fd; pick them
+    # up now so they are handled before the cleanup below.
+    if INOTIFY_ENABLED:
+        read_plot_events()
+    submit_session_task(stream["session"], finish_session_output, stream)
+
+def check_exited_sessions(pending, now):
+    # A PTY only reports EOF once every process holding it is gone, so a
+    # background process left behind by the user's program would keep the
+    # session open forever. Once the program itself has exited, give its
+    # remaining output DRAIN_TIMEOUT seconds to arrive, then end the session
+    # (cleanup kills the rest of its process group).
+    with output_selector_lock:
+        streams = [key.data for key in output_selector.get_map().values()
+                   if key.data is not None]
+    for stream in streams:
         try:
-            while not session_obj["closing"] and child.isalive():
-                try:
-                    chunk = child.read_nonblocking(size=1, timeout=0.1)
-                    if chunk:
-                        socketio.emit("python_output", {"data": chunk}, room=sid)
-                except pexpect.exceptions.TIMEOUT:
-                    pass
-                except pexpect.exceptions.EOF:
-                    break
-
-            if not session_obj["closing"]:
-                leftover = ""
-                try:
-                    leftover = child.read()
-                except:
-                    pass
-                if leftover:
-                    socketio.emit("python_output", {"data": leftover}, room=sid)
+            if stream["drain_deadline"] is None:
+                if stream["child"].poll() is not None:
+                    stream["drain_deadline"] = now + DRAIN_TIMEOUT
+            elif now >= stream["drain_deadline"] and stream["fd"] is not None:
+                end_session_output(stream, pending)
         except Exception as e:
-            socketio.emit("session_error", {"error": str(e)}, room=sid)
+            abort_session_output(stream, pending, e)
 
-        if not session_obj["closing"]:
-            scan_for_new_images(sid)
-            socketio.emit("process_ended", {}, room=sid)
+def abort_session_output(stream, pending, error):
+    # A step failed for this stream: end its session like an EOF would, so
+    # the child, temp dir and ephemeral_sessions entry don't outlive the error,
+    # and keep the selector running for everyone else.
+    logger.exception("output handling failed for session %s", stream["sid"])
+    try:
+        socketio.emit("session_error", {"error": str(error)}, to=stream["sid"])
+        release_session_output(stream, pending)
+    except Exception:
+        logger.exception("could not release output of session %s", stream["sid"])
+    pending.pop(stream["fd"], None)
+    submit_session_task(stream["session"], finish_session_output, stream)
+
+def read_plot_events():
+    while True:
+        try:
+            data = os.read(plot_watch_fd, READ_CHUNK_SIZE)
+        except BlockingIOError:
+            return
 
-        cleanup_ephemeral_session(sid)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            watch = plot_watches.get(wd)
+            if not watch or not name.lower().endswith(PLOT_EXTENSIONS):
+                continue
+            sid, session_obj, tmp_dir = watch
+            path = os.path.join(tmp_dir, name)
+            if not session_obj["closing"] and path not in session_obj["sent_images"]:
+                submit_session_task(session_obj, handle_plot_file, sid, session_obj, path)
+
+def run_output_selector():
+    # One thread multiplexes the PTYs of every running session, so nothing
+    # raised for one session may end this loop: each step is guarded
+    # separately, and the whole iteration once more as a last resort.
+    pending = {}  # fd -> stream with buffered, not yet emitted output
+    next_exit_check = time.monotonic()
+    while True:
+        try:
+            next_exit_check = poll_session_output(pending, next_exit_check)
+        except Exception:
+            logger.exception("output selector iteration failed")
+            time.sleep(READ_POLL_INTERVAL)
+
+def poll_session_output(pending, next_exit_check):
+    while closed_streams:
+        stream = closed_streams.popleft()
+        try:
+            release_session_output(stream, pending)
+        except Exception:
+            logger.exception("could not release output of session %s", stream["sid"])
 
-    t = threading.Thread(target=read_sql_output, daemon=True)
-    session_obj["thread"] = t
-    t.start()
+    timeout = READ_POLL_INTERVAL
+    if pending:
+        oldest = min(st["last_flush_ts"] for st in pending.values())
+        timeout = max(0, oldest + OUTPUT_FLUSH_INTERVAL - time.monotonic())
 
-    socketio.emit("session_started", {}, room=sid)
+    try:
+        events = output_selector.select(timeout)
+    except OSError:
+        events = []
+
+    for key, _ in events:
+        if key.data is None:
+            try:
+                read_plot_events()
+            except Exception:
+                logger.exception("reading plot events failed")
+            continue
+        stream = key.data
+        try:
+            read_session_output(stream, pending)
+        except Exception as e:
+            abort_session_output(stream, pending, e)
+
+    now = time.monotonic()
+    if now >= next_exit_check:
+        check_exited_sessions(pending, now)
+        next_exit_check = now + READ_POLL_INTERVAL
+
+    for fd, stream in list(pending.items()):
+        try:
+            if not stream["buf"]:
+                del pending[fd]
+            elif now - stream["last_flush_ts"] >= OUTPUT_FLUSH_INTERVAL:
+                flush_session_output(stream)
+                del pending[fd]
+        except Exception as e:
+            pending.pop(fd, None)
+            abort_session_output(stream, pending, e)
+
+    return next_exit_check
+
+def ensure_session_runtime():
+    # Called from start_session instead of at import: ScreenShare imports this
+    # module a second time when it runs as __main__, and the debug reloader
+    # imports it in a second process, neither of which ever runs a session.
+    global session_runtime_started, plot_watch_fd, INOTIFY_ENABLED
+    with session_runtime_lock:
+        if session_runtime_started:
+            return
+        if _libc is not None:
+            plot_watch_fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            INOTIFY_ENABLED = plot_watch_fd >= 0
+        if INOTIFY_ENABLED:
+            output_selector.register(plot_watch_fd, selectors.EVENT_READ, data=None)
+        threading.Thread(target=run_output_selector, daemon=True).start()
+        session_runtime_started = True
 
 @socketio.on("send_input")
 def handle_send_input(data):
     sid = request.sid
     session_obj = ephemeral_sessions.get(sid)
     if not session_obj:
-        socketio.emit("python_output", {"data": "[No active session]\n"}, room=sid)
-        socketio.emit("process_ended", {}, room=sid)
+        socketio.emit("python_output", {"data": "[No active session]\n"}, to=sid)
+        socketio.emit("process_ended", {}, to=sid)
         return
 
     if session_obj["closing"]:
-        socketio.emit("python_output", {"data": "[Session closed]\n"}, room=sid)
-        socketio.emit("process_ended", {}, room=sid)
+        socketio.emit("python_output", {"data": "[Session closed]\n"}, to=sid)
+        socketio.emit("process_ended", {}, to=sid)
         cleanup_ephemeral_session(sid)
         return
 
     child = session_obj.get("child")
-    if not child or not child.isalive():
-        socketio.emit("python_output", {"data": "[No active session]\n"}, room=sid)
-        socketio.emit("process_ended", {}, room=sid)
-        cleanup_ephemeral_session(sid)
+    stream = session_obj.get("stream")
+    input_fd = None
+    if child and child.poll() is None and stream:
+        # The selector thread may close stream["fd"] at any moment, and its
+        # number may then be reused by another session's PTY; write through
+        # our own duplicate taken while the fd is known to be open.
+        with stream["lock"]:
+            if stream["fd"] is not None:
+                input_fd = os.dup(stream["fd"])
+    if input_fd is None:
+        socketio.emit("python_output", {"data": "[No active session]\n"}, to=sid)
+        socketio.emit("process_ended", {}, to=sid)
+        cleanup_ephemeral_session(sid, session_obj)
         return
 
     line = data.get("line", "")
-    child.sendline(line)
+    try:
+        os.write(input_fd, (line + "\n").encode("utf-8"))
+    except OSError:
+        pass
+    finally:
+        os.close(input_fd)
 
 @socketio.on("disconnect_session")
 def handle_disconnect_session():
     sid = request.sid
     session_obj = ephemeral_sessions.get(sid)
     if session_obj and not session_obj["closing"]:
-        socketio.emit("python_output", {"data": "[Session killed by user]\n"}, room=sid)
+        socketio.emit("python_output", {"data": "[Session killed by user]\n"}, to=sid)
     cleanup_ephemeral_session(sid)
-    socketio.emit("process_ended", {}, room=sid)
+    socketio.emit("process_ended", {}, to=sid)
 
 # ---------------------------
 # 4) File/Plot & Session Cleanup
 # ---------------------------
 
-def scan_for_new_images(sid):
-    session_obj = ephemeral_sessions.get(sid)
-    if not session_obj:
+def watch_plot_dir(sid, session_obj, tmp_dir):
+    # cleanup_ephemeral_session sets "closing" under the same lock before it
+    # unwatches, so a watch is either seen by that unwatch or never added.
+    if not INOTIFY_ENABLED:
+        return
+    with session_obj["lock"]:
+        if session_obj["closing"]:
+            return
+        wd = _libc.inotify_add_watch(plot_watch_fd, os.fsencode(tmp_dir),
+                                     IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            return
+        plot_watches[wd] = (sid, session_obj, tmp_dir)
+        session_obj["plot_watch"] = wd
+    if not session_is_live(sid, session_obj):
+        unwatch_plot_dir(session_obj)
+
+def unwatch_plot_dir(session_obj):
+    with session_obj["lock"]:
+        wd = session_obj.get("plot_watch")
+        session_obj["plot_watch"] = None
+    if wd is None:
+        return
+    # drop our entry first: once removed, the kernel may hand wd to a new watch
+    plot_watches.pop(wd, None)
+    _libc.inotify_rm_watch(plot_watch_fd, wd)
+
+def scan_for_new_images(sid, session_obj):
+    if not session_is_live(sid, session_obj):
         return
 
     tmp_dir = session_obj.get("temp_dir")
     if not tmp_dir or not os.path.isdir(tmp_dir):
         return
 
-    patterns = ["*.png", "*.jpg", "*.jpeg"]
-    for pat in patterns:
+    for pat in PLOT_PATTERNS:
         for path in glob.glob(os.path.join(tmp_dir, pat)):
             if path not in session_obj["sent_images"]:
-                handle_plot_file(sid, path)
+                handle_plot_file(sid, session_obj, path)
 
-def handle_plot_file(sid, filepath):
-    session_obj = ephemeral_sessions.get(sid)
-    if not session_obj:
+def handle_plot_file(sid, session_obj, filepath):
+    # The task may run after the user stopped or re-ran; never act on behalf
+    # of a session other than the one that wrote the file.
+    if not session_is_live(sid, session_obj):
+        return
+    # every close of a rewritten file raises another event; send it once
+    if filepath in session_obj["sent_images"]:
         return
 
     if not os.path.exists(filepath):
         socketio.emit("session_error",
                       {"error": f"Plot file not found: {filepath}"},
-                      room=sid)
+                      to=sid)
         return
 
     try:
-        if PIL_ENABLED:
+        max_dim = 800
+        if VIPS_ENABLED:
+            im = pyvips.Image.thumbnail(filepath, max_dim, height=max_dim, size="down")
+            image_data = im.write_to_buffer(".png[compression=6]")
+        elif PIL_ENABLED:
             from PIL import Image
             im = Image.open(filepath)
-            max_dim = 800
             if im.width > max_dim or im.height > max_dim:
                 im.thumbnail((max_dim, max_dim))
             import io
@@ -443,47 +994,98 @@ def handle_plot_file(sid, filepath):
             with open(filepath, "rb") as f:
                 image_data = f.read()
 
-        b64 = base64.b64encode(image_data).decode("utf-8")
+        # bytes go out as a binary Socket.IO attachment, no base64 round trip
         socketio.emit("plot_image", {
             "filename": os.path.basename(filepath),
-            "image_base64": b64
-        }, room=sid)
+            "image": image_data
+        }, to=sid)
 
         session_obj["sent_images"].add(filepath)
     except Exception as e:
         socketio.emit("session_error",
                       {"error": f"Could not handle plot file {filepath}: {str(e)}"},
-                      room=sid)
+                      to=sid)
 
-def cleanup_ephemeral_session(sid):
-    session_obj = ephemeral_sessions.get(sid)
-    if not session_obj:
-        return
-    if session_obj["closing"]:
+def acquire_session_dir():
+    try:
+        return DIR_POOL.get_nowait()
+    except queue.Empty:
+        return tempfile.mkdtemp(prefix="user_session_")
+
+def release_session_dir(tmp_dir, session_obj=None):
+    # Empty the directory and hand it back to the pool; only remove it
+    # outright if it cannot be emptied or the pool is already full. A dir
+    # whose start_session handler may still write into it is never pooled.
+    if session_obj is not None and session_obj["starting"]:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
         return
+    try:
+        with os.scandir(tmp_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+        os.chmod(tmp_dir, 0o700)
+        DIR_POOL.put_nowait(tmp_dir)
+    except (OSError, queue.Full):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
-    session_obj["closing"] = True
+def drain_session_dir_pool():
+    while True:
+        try:
+            shutil.rmtree(DIR_POOL.get_nowait(), ignore_errors=True)
+        except queue.Empty:
+            return
 
-    child = session_obj.get("child")
-    if child and child.isalive():
-        child.terminate(force=True)
+atexit.register(drain_session_dir_pool)
 
-    tmp_dir = session_obj.get("temp_dir")
-    if tmp_dir and os.path.isdir(tmp_dir):
-        shutil.rmtree(tmp_dir, ignore_errors=True)
-    session_obj["temp_dir"] = None
+def cleanup_ephemeral_session(sid, session_obj=None):
+    # Pass session_obj when the caller holds a specific session, so that a
+    # late cleanup never tears down a newer session started under the same sid.
+    if session_obj is None:
+        session_obj = ephemeral_sessions.get(sid)
+    if not session_obj:
+        return
+    with session_obj["lock"]:
+        if session_obj["closing"]:
+            return
+        session_obj["closing"] = True
+
+    compile_child = session_obj.get("compile_child")
+    if compile_child:
+        kill_session_process(compile_child)
 
-    sql_dir = session_obj.get("sql_temp_dir")
-    if sql_dir and os.path.isdir(sql_dir):
-        shutil.rmtree(sql_dir, ignore_errors=True)
-    session_obj["sql_temp_dir"] = None
+    child = session_obj.get("child")
+    if child:
+        kill_session_process(child)
+
+    stream = session_obj.get("stream")
+    if stream:
+        closed_streams.append(stream)
+
+    unwatch_plot_dir(session_obj)
+
+    with session_obj["lock"]:
+        dirs = [d for d in (session_obj["temp_dir"], session_obj["sql_temp_dir"]) if d]
+        session_obj["temp_dir"] = None
+        session_obj["sql_temp_dir"] = None
+        if session_obj["starting"]:
+            # start_session may still be writing into them; finish_session_start
+            # releases them once it is done
+            session_obj["deferred_dirs"] += dirs
+            dirs = []
+    for tmp_dir in dirs:
+        CLEANUP_POOL.submit(release_session_dir, tmp_dir, session_obj)
 
     session_obj["child"] = None
+    session_obj["compile_child"] = None
     session_obj["temp_file"] = None
-    session_obj["thread"] = None
+    session_obj["stream"] = None
     session_obj["sent_images"] = set()
 
-    ephemeral_sessions.pop(sid, None)
+    if ephemeral_sessions.get(sid) is session_obj:
+        ephemeral_sessions.pop(sid, None)
 
 # -----------
 # 5) Run
@@ -61,7 +61,10 @@ function App() {
 
   const startSession = () => {
     setConsoleOutput("Starting session...\n");
-    setPlotImages([]); 
+    setPlotImages((prev) => {
+      prev.forEach((url) => URL.revokeObjectURL(url));
+      return [];
+    });
     setUserInput(""); 
 
     if (!socketRef.current) {
@@ -106,8 +109,9 @@ function App() {
     });
 
     socket.on("plot_image", (data) => {
-      const base64 = `data:image/png;base64,${data.image_base64}`; 
-      setPlotImages((prev) => [...prev, base64]);
+      // image arrives as a binary attachment (ArrayBuffer), not base64
+      const url = URL.createObjectURL(new Blob([data.image]));
+      setPlotImages((prev) => [...prev, url]);
     });
   };
 
@@ -231,7 +231,10 @@
    
      function startEphemeralSession() {
        setConsoleOutput("Starting session...\n");
-       setPlotImages([]);
+       setPlotImages((prev) => {
+         prev.forEach((url) => URL.revokeObjectURL(url));
+         return [];
+       });
        setUserInput("");
    
        if (!compilerSocketRef.current) {
@@ -278,8 +281,9 @@
        });
    
        sock.on("plot_image", (data) => {
-         const base64 = "data:image/png;base64," + data.image_base64;
-         setPlotImages((prev) => [...prev, base64]);
+         // image arrives as a binary attachment (ArrayBuffer), not base64
+         const url = URL.createObjectURL(new Blob([data.image]));
+         setPlotImages((prev) => [...prev, url]);
        });
      }
    